@@ -2,8 +2,10 @@
 
 import ConfigParser
 import argparse
+import json
 from scapy.all import *
 
+from paxoscore import profiler
 from paxoscore.learner import Learner
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -12,11 +14,13 @@ sys.path.append(THIS_DIR)
 
 class SimpleDatabase(object):
     """
-    Simple database backend
+    Simple database backend. Keys starting with expensive_prefix are marked
+    expensive, so their commands are applied on the workers of the learner.
     """
 
-    def __init__(self):
+    def __init__(self, expensive_prefix=None):
         self.db = {}
+        self.expensive_prefix = expensive_prefix
 
     def execute(self, cmd, d):
         if cmd['action'] == 'put':
@@ -33,11 +37,30 @@ class SimpleDatabase(object):
             except KeyError:
                 d.callback("None\n")
 
+    def is_expensive(self, cmd):
+        if not self.expensive_prefix:
+            return False
+
+        keys = cmd.get('key') if isinstance(cmd, dict) else None
+        if not isinstance(keys, list) or not keys:
+            return False
+        return isinstance(keys[0], basestring) and keys[0].startswith(self.expensive_prefix)
+
+    def snapshot(self):
+        return json.dumps(self.db)
+
+    def restore(self, data):
+        self.db = json.loads(data)
+
 
 def main():
     parser = argparse.ArgumentParser(description='Paxos Proposer.')
     parser.add_argument('--cfg', required=True)
+    parser.add_argument('--iface', default=None, help='Interface to sniff on, all by default')
+    profiler.add_arguments(parser)
     args = parser.parse_args()
+    if args.iface == 'lo':
+        conf.L3socket = L3RawSocket
     config = ConfigParser.ConfigParser()
     config.read(args.cfg)
 
@@ -47,14 +70,45 @@ def main():
     count = config.getint('instance', 'count')
     timeout = config.getint('timeout', 'second')
 
-    learner = Learner(num_acceptors, learner_addr, learner_port)
-    dbserver = SimpleDatabase()
-    learner.add_deliver(dbserver.execute)
+    if config.has_section('apply'):
+        learner = Learner(num_acceptors, learner_addr, learner_port,
+                          config.getint('apply', 'queue'), config.getint('apply', 'workers'))
+    else:
+        learner = Learner(num_acceptors, learner_addr, learner_port)
+    expensive_prefix = None
+    if config.has_option('apply', 'expensive_prefix'):
+        expensive_prefix = config.get('apply', 'expensive_prefix')
+    dbserver = SimpleDatabase(expensive_prefix)
+
+    timers = None
+    if args.profile is not None:
+        timers = profiler.Timers()
+        timers.install(learner, ['handle_pkt', 'delivery_msg', 'respond'])
+        timers.install(dbserver, ['execute'])
+
+    learner.add_deliver(dbserver.execute, dbserver.is_expensive)
+    learner.add_snapshot(dbserver.snapshot, dbserver.restore)
+
+    if config.has_section('catchup'):
+        peers = []
+        for peer in config.get('catchup', 'peers').split(','):
+            if peer.strip():
+                host, port = peer.strip().split(':')
+                peers.append((host, int(port)))
+
+        learner.serve_catchup(config.getint('catchup', 'port'))
+        learner.add_catchup_peers(peers, config.getint('catchup', 'gap'))
+        learner.catch_up()
+
+    sampler = profiler.from_arguments(args, timers)
     try:
-        learner.start(count, timeout)
+        learner.start(count, timeout, args.iface)
     except (KeyboardInterrupt, SystemExit):
-        learner.stop()
         sys.exit()
+    finally:
+        learner.stop()
+        if sampler is not None:
+            sampler.stop()
 
 
 if __name__ == '__main__':
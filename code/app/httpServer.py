@@ -7,14 +7,35 @@ import json
 import os
 from twisted.internet import reactor
 from twisted.web import static
+from twisted.web.http import HTTPChannel
 from twisted.web.resource import Resource
 from twisted.web.server import Site, NOT_DONE_YET
-from paxoscore.proposer import Proposer
+from paxoscore import profiler
+from paxoscore.proposer import Proposer, VALUE_SIZE
 
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+HTTP_BACKLOG = 1024
+HTTP_IDLE_TIMEOUT = 60
 logging.basicConfig(filename="/server.log", level=logging.DEBUG, format='%(message)s')
 
 
+class PipelinedChannel(HTTPChannel):
+    """
+    HTTP channel answering pipelined requests strictly one at a time. Without
+    it, requests with no body that follow in the same read are dispatched while
+    the previous one still waits for its Paxos response.
+    """
+
+    def allContentReceived(self):
+        rest, self._buffer = self._buffer, ''
+        HTTPChannel.allContentReceived(self)
+
+        if self._handlingRequest:
+            self._dataBuffer.append(rest)
+        else:
+            self._buffer = rest + self._buffer
+
+
 class MainPage(Resource):
     def getChild(self, name, request):
         if name == '':
@@ -44,32 +65,136 @@ class WebServer(Resource):
         except Exception as ex:
             logging.error("Error sending response [{}] => [{}]".format(result, ex))
 
+    def _failResponse(self, failure, request):
+        try:
+            logging.error("Request failed [{}]".format(failure.getErrorMessage()))
+            request.setResponseCode(504)
+            request.write('Timeout')
+            request.finish()
+        except Exception as ex:
+            logging.error("Error sending failure [{}] => [{}]".format(failure, ex))
+
     def render_GET(self, request):
-        print request
         request.args['action'] = 'get'
         data = json.dumps(request.args)
 
         logging.info("Received get request with [{}]".format(data))
 
         d = self.proposer.submit(data)
-        d.addCallback(self._waitResponse, request)
+        d.addCallbacks(self._waitResponse, self._failResponse,
+                       callbackArgs=(request,), errbackArgs=(request,))
         return NOT_DONE_YET
 
     def render_POST(self, request):
-        print request
         request.args['action'] = 'put'
         data = json.dumps(request.args)
 
         logging.info("Received post request with [{}]".format(data))
 
         d = self.proposer.submit(data)
-        d.addCallback(self._waitResponse, request)
+        d.addCallbacks(self._waitResponse, self._failResponse,
+                       callbackArgs=(request,), errbackArgs=(request,))
         return NOT_DONE_YET
 
 
+class BatchServer(Resource):
+    """
+    Submit many operations in one request. The body is a JSON list such as
+    [{"action": "put", "key": "k", "value": "v"}, {"action": "get", "key": "k"}]
+    and the results are streamed back one per line, in the order of the list.
+    """
+    isLeaf = True
+
+    def __init__(self, proposer):
+        Resource.__init__(self)
+        self.proposer = proposer
+
+    @staticmethod
+    def _parse(body):
+        ops = json.loads(body)
+        if not isinstance(ops, list):
+            raise ValueError("Batch must be a list of operations")
+
+        commands = []
+        for op in ops:
+            if not isinstance(op, dict):
+                raise ValueError("Invalid operation [{}]".format(op))
+
+            action = op.get('action')
+            if action not in ('put', 'get') or not isinstance(op.get('key'), basestring):
+                raise ValueError("Invalid operation [{}]".format(op))
+
+            cmd = {'action': action, 'key': [op['key']]}
+            if action == 'put':
+                if not isinstance(op.get('value'), basestring):
+                    raise ValueError("Put without a string value [{}]".format(op))
+                cmd['value'] = [op['value']]
+
+            data = json.dumps(cmd)
+            if len(data) > VALUE_SIZE - 1:
+                raise ValueError("Operation longer than [{}] bytes once encoded [{}]".format(VALUE_SIZE - 1, op))
+            commands.append(data)
+
+        return commands
+
+    def render_POST(self, request):
+        try:
+            commands = self._parse(request.content.read())
+        except Exception as ex:
+            logging.error("Invalid batch request [{}]".format(ex))
+            request.setResponseCode(400)
+            return 'Invalid batch: %s\n' % ex
+
+        logging.info("Received batch request with [{}] operations".format(len(commands)))
+
+        state = {'results': [None] * len(commands), 'next': 0, 'closed': False}
+        request.notifyFinish().addErrback(self._closed, state)
+
+        if not commands:
+            return ''
+
+        request.setHeader('content-type', 'text/plain')
+        for index, data in enumerate(commands):
+            d = self.proposer.submit(data)
+            d.addCallbacks(self._done, self._done, callbackArgs=(index, False, request, state),
+                           errbackArgs=(index, True, request, state))
+        return NOT_DONE_YET
+
+    @staticmethod
+    def _closed(failure, state):
+        logging.error("Batch connection lost [{}]".format(failure.getErrorMessage()))
+        state['closed'] = True
+
+    @staticmethod
+    def _done(result, index, failed, request, state):
+        """
+        Store the result of one operation and write every result that is ready
+        in order, so the client sees them as soon as the prefix is decided.
+        """
+        results = state['results']
+        results[index] = 'Timeout' if failed else result.rstrip('\t\r\n\0')
+
+        ready = []
+        while state['next'] < len(results) and results[state['next']] is not None:
+            ready.append(results[state['next']])
+            results[state['next']] = ''
+            state['next'] += 1
+
+        if state['closed'] or not ready:
+            return
+
+        try:
+            request.write('\n'.join(ready) + '\n')
+            if state['next'] == len(results):
+                request.finish()
+        except Exception as ex:
+            logging.error("Error sending batch response => [{}]".format(ex))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Paxos Proposer.')
     parser.add_argument('--cfg', required=True)
+    profiler.add_arguments(parser)
     args = parser.parse_args()
     config = ConfigParser.ConfigParser()
     config.read(args.cfg)
@@ -86,13 +211,23 @@ if __name__ == '__main__':
 
     root = MainPage()
     server = WebServer(proposer)
+
+    if args.profile is not None:
+        timers = profiler.Timers()
+        timers.install(server, ['render_GET', 'render_POST', '_waitResponse'])
+        timers.install(proposer, ['submit', 'datagramReceived'])
+        sampler = profiler.from_arguments(args, timers)
+        reactor.addSystemEventTrigger('before', 'shutdown', sampler.stop)
+
     root.putChild('jquery.min.js', static.File('%s/web/jquery.min.js' % THIS_DIR))
     root.putChild('get', server)
     root.putChild('put', server)
-    factory = Site(root)
+    root.putChild('batch', BatchServer(proposer))
+    factory = Site(root, timeout=HTTP_IDLE_TIMEOUT)
+    factory.protocol = PipelinedChannel
 
     try:
-        reactor.listenTCP(8080, factory)
+        reactor.listenTCP(8080, factory, backlog=HTTP_BACKLOG)
         reactor.run()
     except Exception as ex:
         logging.error("Error listening tcp: [{}]".format(ex))
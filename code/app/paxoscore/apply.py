@@ -0,0 +1,168 @@
+#!/usr/bin/python
+"""
+Apply stage of the learner, decoupling the delivery of decided commands to
+the application from the handling of the packets.
+
+Commands are queued in decided order and applied by a dedicated thread.
+Commands marked expensive are offloaded to a pool of workers, and a later
+command touching the same key waits for them, so the commands on each key
+are still applied in decided order.
+"""
+
+import Queue
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+APPLY_QUEUE_SIZE = 1024
+APPLY_WORKERS = 4
+
+_APPLY = 0
+_BARRIER = 1
+_STOP = 2
+_ALL_KEYS = object()
+
+
+class ApplyStage(object):
+    """
+    Bounded queue of decided commands with a thread applying them in order.
+    Submitting blocks once the queue is full, so a slow application slows
+    down the receiving side instead of growing the queue forever.
+    """
+
+    def __init__(self, queue_size=APPLY_QUEUE_SIZE, workers=APPLY_WORKERS):
+        self.queue = Queue.Queue(queue_size)
+        self.pool = ThreadPoolExecutor(workers)
+        self.inflight = {}
+        self.thread = threading.Thread(target=self._run, name='apply')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, deliver, cmd, d, expensive=False):
+        """
+        Queue the command to be delivered to the application, which fires d
+        with the result once it is applied.
+        """
+        self.queue.put((_APPLY, deliver, cmd, d, expensive))
+
+    def barrier(self, fn):
+        """
+        Run fn once every command queued before it has been applied, and
+        return its result.
+        """
+        done = threading.Event()
+        box = []
+        self.queue.put((_BARRIER, fn, done, box))
+        done.wait()
+
+        result, error = box[0]
+        if error is not None:
+            raise error
+        return result
+
+    def stop(self):
+        """
+        Apply every queued command, then stop the apply thread and shut the
+        workers down.
+        """
+        self.barrier(lambda: None)
+        self.queue.put((_STOP,))
+        self.thread.join()
+        self.pool.shutdown()
+
+    @staticmethod
+    def _keys(cmd):
+        """
+        Return the keys touched by the command. A command whose keys cannot be
+        told conflicts with every other command.
+        """
+        keys = cmd.get('key') if isinstance(cmd, dict) else None
+        if not isinstance(keys, list) or not keys:
+            return [_ALL_KEYS]
+
+        for key in keys:
+            try:
+                hash(key)
+            except TypeError:
+                return [_ALL_KEYS]
+        return keys
+
+    def _conflicts(self, keys):
+        for key, future in self.inflight.items():
+            if future.done():
+                del self.inflight[key]
+
+        if _ALL_KEYS in keys:
+            return self.inflight.values()
+
+        return [self.inflight[k] for k in keys + [_ALL_KEYS] if k in self.inflight]
+
+    @staticmethod
+    def _deliver(deliver, cmd, d):
+        try:
+            deliver(cmd, d)
+        except Exception as ex:
+            logging.error("Error applying command [{}] => [{}]".format(cmd, ex))
+
+    def _complete(self, future, deliver, cmd, d):
+        self._deliver(deliver, cmd, d)
+        future.set_result(None)
+
+    def _offload(self, conflicts, deliver, cmd, d):
+        """
+        Run the command on the workers once all the conflicting commands are
+        applied, without holding a worker while waiting for them.
+        """
+        future = Future()
+        remaining = [len(conflicts)]
+        lock = threading.Lock()
+
+        def run(_=None):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            self.pool.submit(self._complete, future, deliver, cmd, d)
+
+        if not conflicts:
+            run()
+        for conflict in conflicts:
+            conflict.add_done_callback(run)
+
+        return future
+
+    def _apply(self, deliver, cmd, d, expensive):
+        keys = self._keys(cmd)
+        conflicts = self._conflicts(keys)
+
+        if not expensive and not conflicts:
+            self._deliver(deliver, cmd, d)
+            return
+
+        future = self._offload(conflicts, deliver, cmd, d)
+        for key in keys:
+            self.inflight[key] = future
+
+    def _barrier(self, fn, done, box):
+        wait(self.inflight.values())
+        self.inflight.clear()
+        try:
+            box.append((fn(), None))
+        except Exception as ex:
+            box.append((None, ex))
+        finally:
+            done.set()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job[0] == _STOP:
+                return
+
+            try:
+                if job[0] == _BARRIER:
+                    self._barrier(*job[1:])
+                else:
+                    self._apply(*job[1:])
+            except Exception as ex:
+                logging.error("Unexpected error in the apply stage [{}]".format(ex))
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+"""
+Catch-up protocol used by lagging or restarted learners to fetch the
+application snapshot and the decided log from a healthy peer over TCP.
+
+Wire format, all integers in network order:
+
+    request : Q from_instance
+    response: Q watermark | I snapshot_len | snapshot
+              then chunks of I chunk_len | records, where a record is
+              Q instance | H value_len | value. A chunk of length zero
+              closes the stream.
+
+The snapshot covers every instance up to the watermark, and the records are
+the instances decided above it while the snapshot was being sent. When the
+requester is not behind the watermark, the snapshot is empty.
+"""
+
+import logging
+import socket
+import struct
+import threading
+import SocketServer
+
+CHUNK_SIZE = 256 * 1024
+SOCKET_BUFFER = 4 * 1024 * 1024
+CONNECT_TIMEOUT = 5
+MIN_TRANSFER_RATE = 64 * 1024
+READ_TIMEOUT = max(CONNECT_TIMEOUT, CHUNK_SIZE / MIN_TRANSFER_RATE)
+
+REQUEST = struct.Struct('>Q')
+HEADER = struct.Struct('>Q I')
+CHUNK = struct.Struct('>I')
+RECORD = struct.Struct('>Q H')
+
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise IOError("Catch-up stream closed after [{}] of [{}] bytes".format(len(data), size))
+    return data
+
+
+def _encode_chunks(entries):
+    """
+    Pack the (instance, value) pairs into chunks of at most CHUNK_SIZE bytes,
+    so the suffix is sent with a few large writes instead of one per instance.
+    """
+    chunk = []
+    size = 0
+    for inst, value in entries:
+        record = RECORD.pack(inst, len(value)) + value
+        if size + len(record) > CHUNK_SIZE and chunk:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+        chunk.append(record)
+        size += len(record)
+
+    if chunk:
+        yield ''.join(chunk)
+
+
+def _decode_chunk(data):
+    offset = 0
+    while offset < len(data):
+        inst, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        yield inst, data[offset:offset + length]
+        offset += length
+
+
+class CatchupHandler(SocketServer.StreamRequestHandler):
+    """
+    Serves a single catch-up request: the snapshot followed by the decided
+    log suffix above the watermark of the snapshot.
+    """
+    timeout = READ_TIMEOUT
+
+    def handle(self):
+        try:
+            from_inst, = REQUEST.unpack(_read_exact(self.rfile, REQUEST.size))
+            learner = self.server.learner
+            watermark, snapshot = learner.export_snapshot(from_inst)
+
+            self.wfile.write(HEADER.pack(watermark, len(snapshot)))
+            self.wfile.write(snapshot)
+
+            entries = learner.export_suffix(watermark) if snapshot else []
+            logging.info("Catch-up to [{}] from instance [{}] at watermark [{}] with [{}] entries".format(
+                self.client_address, from_inst, watermark, len(entries)))
+
+            for chunk in _encode_chunks(entries):
+                self.wfile.write(CHUNK.pack(len(chunk)))
+                self.wfile.write(chunk)
+            self.wfile.write(CHUNK.pack(0))
+        except Exception as ex:
+            logging.error("Error serving catch-up to [{}] => [{}]".format(self.client_address, ex))
+
+
+class CatchupServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    TCP server that hands the state of a learner to its peers. Each request
+    is served on its own thread, so it runs alongside the sniffing loop.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, learner, port):
+        SocketServer.TCPServer.__init__(self, ('', port), CatchupHandler)
+        self.learner = learner
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='catchup-server')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def fetch_state(addr, port, from_inst):
+    """
+    Fetch the state of the learner at (addr, port), returning a tuple with the
+    watermark, the application snapshot covering it and the decided log
+    entries above it. A peer stalling for READ_TIMEOUT aborts the fetch.
+    """
+    sock = socket.create_connection((addr, port), CONNECT_TIMEOUT)
+    try:
+        sock.settimeout(READ_TIMEOUT)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        sock.sendall(REQUEST.pack(from_inst))
+
+        stream = sock.makefile('rb', CHUNK_SIZE)
+        watermark, snapshot_len = HEADER.unpack(_read_exact(stream, HEADER.size))
+        snapshot = _read_exact(stream, snapshot_len)
+
+        logs = {}
+        while True:
+            length, = CHUNK.unpack(_read_exact(stream, CHUNK.size))
+            if length == 0:
+                break
+            for inst, value in _decode_chunk(_read_exact(stream, length)):
+                logs[inst] = value
+
+        stream.close()
+        return watermark, snapshot, logs
+    finally:
+        sock.close()
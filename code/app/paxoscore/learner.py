@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import netifaces
+import threading
 from math import ceil
 
 import json
@@ -9,6 +10,9 @@ from scapy.layers.inet import IP, UDP
 from scapy.layers.l2 import Ether
 from twisted.internet import defer
 
+from paxoscore.apply import ApplyStage, APPLY_QUEUE_SIZE, APPLY_WORKERS
+from paxoscore.catchup import CatchupServer, fetch_state
+
 logging.basicConfig(filename="learner.log", level=logging.DEBUG, format='%(message)s')
 VALUE_SIZE = 64
 PHASE_1A = 1
@@ -145,10 +149,12 @@ class Learner(object):
     If a decision has been made, the learner delivers that decision to the application.
     """
 
-    def __init__(self, num_acceptors, learner_addr, learner_port):
+    def __init__(self, num_acceptors, learner_addr, learner_port,
+                 apply_queue=APPLY_QUEUE_SIZE, apply_workers=APPLY_WORKERS):
         """
         Initialize a learner with the number of acceptors, maximum number of requests,
-        and the running duration.
+        and the running duration. Decided commands wait in a queue of apply_queue
+        commands, and the expensive ones run on apply_workers threads.
         """
         self.learner = PaxosLearner(num_acceptors)
         self.learner_addr = learner_addr
@@ -156,6 +162,15 @@ class Learner(object):
         self.min_uncommited_index = 1
         self.max_instance = 1
         self.deliver = None
+        self.expensive = None
+        self.applier = ApplyStage(apply_queue, apply_workers)
+        self.snapshot = None
+        self.restore = None
+        self.catchup_peers = []
+        self.catchup_gap = 0
+        self.catchup_running = False
+        self.snapshot_inst = 0
+        self.lock = threading.RLock()
 
     @staticmethod
     def respond(result, req_id, dst, sport, dport):
@@ -192,19 +207,176 @@ class Learner(object):
 
             sendp(pkt_header / msg, iface=itf, verbose=True)
 
-    def add_deliver(self, deliver_cb):
+    def add_deliver(self, deliver_cb, expensive_cb=None):
         """
         This method allows the application server attach the request handler when such a
-        request has been chosen for servicing.
+        request has been chosen for servicing. The optional expensive_cb tells which
+        commands are slow enough to be applied on a worker thread.
         """
         self.deliver = deliver_cb
+        self.expensive = expensive_cb
+
+    def add_snapshot(self, snapshot_cb, restore_cb):
+        """
+        This method allows the application server attach the handlers used to
+        export and install its state when a peer learner is catching up.
+        """
+        self.snapshot = snapshot_cb
+        self.restore = restore_cb
+
+    def serve_catchup(self, port):
+        """
+        Start serving the state of this learner to lagging peers on the given TCP port.
+        """
+        server = CatchupServer(self, port)
+        server.start()
+        logging.info("Serving catch-up on port [{}]".format(port))
+        return server
+
+    def add_catchup_peers(self, peers, gap):
+        """
+        Configure the peers used to catch up, and how many instances this
+        learner can fall behind before fetching the state from them. Peers
+        on the addresses of this host are ignored.
+        """
+        local = set()
+        for itf in netifaces.interfaces():
+            for addr in netifaces.ifaddresses(itf).get(netifaces.AF_INET, []):
+                local.add(addr['addr'])
+
+        self.catchup_peers = [(addr, port) for addr, port in peers if addr not in local]
+        self.catchup_gap = gap
+
+    def _advance_commited(self):
+        """
+        Move min_uncommited_index past the instances decided with no gap below.
+        """
+        while self.min_uncommited_index in self.learner.logs:
+            self.min_uncommited_index += 1
+
+    def export_snapshot(self, from_inst):
+        """
+        Return the watermark and the application snapshot covering every
+        instance delivered up to it, or an empty snapshot if a peer asking
+        from from_inst is not behind this learner. The watermark is the last
+        instance decided with no gap below, so a peer never skips an instance
+        this learner has not received yet.
+        """
+        def export():
+            watermark = self.min_uncommited_index - 1
+            if self.snapshot is None or from_inst > self.max_instance:
+                return watermark, ''
+            return watermark, self.snapshot()
+
+        with self.lock:
+            return self.applier.barrier(export)
+
+    def export_suffix(self, watermark):
+        """
+        Return the decided log entries above the watermark, in instance order.
+        """
+        with self.lock:
+            return sorted((i, v) for i, v in self.learner.logs.iteritems() if i > watermark)
+
+    def install_state(self, watermark, snapshot, logs):
+        """
+        Install the state fetched from a peer. The snapshot covers the instances
+        up to the watermark. Above it, the entries fetched and the ones this
+        learner already decided are applied again on top of the snapshot, in
+        instance order, while delivery is held.
+        """
+        if not snapshot:
+            return False
+
+        with self.lock:
+            if self.restore is not None:
+                self.applier.barrier(lambda: self.restore(snapshot))
+
+            entries = dict((i, v) for i, v in self.learner.logs.iteritems() if i > watermark)
+            entries.update(logs)
+            for inst in sorted(entries):
+                state = PaxosLearner.LearnerState(0)
+                state.val = entries[inst]
+                state.saved = True
+                self.learner.states[inst] = state
+                self.learner.logs[inst] = entries[inst]
+                self.delivery_msg(inst)
+
+            self.snapshot_inst = max(self.snapshot_inst, watermark)
+            self.max_instance = max([self.max_instance, watermark] + entries.keys())
+            self.min_uncommited_index = max(self.min_uncommited_index, watermark + 1)
+            self._advance_commited()
+
+        return True
+
+    def catch_up(self, from_inst=None):
+        """
+        Fetch the snapshot and the decided log suffix from the first reachable
+        peer, for a learner missing the instances from from_inst on. Return
+        True if the state was installed.
+        """
+        if from_inst is None:
+            from_inst = self.max_instance + 1
+
+        for addr, port in self.catchup_peers:
+            try:
+                watermark, snapshot, logs = fetch_state(addr, port, from_inst)
+                installed = self.install_state(watermark, snapshot, logs)
+
+                logging.info("Caught up with [{}:{}] from [{}] to watermark [{}] with [{}] entries".format(
+                    addr, port, from_inst, watermark, len(logs)))
+                return installed
+            except Exception as ex:
+                logging.error("Error catching up with [{}:{}] => [{}]".format(addr, port, ex))
+
+        return False
+
+    def _catch_up_background(self, from_inst):
+        try:
+            self.catch_up(from_inst)
+        finally:
+            self.catchup_running = False
+
+    def check_gap(self, inst):
+        """
+        Start a catch-up in background if the instance is too far ahead of the
+        last one this learner has seen.
+        """
+        if not self.catchup_peers or self.catchup_gap <= 0 or self.catchup_running:
+            return
+
+        if inst - self.max_instance > self.catchup_gap:
+            self.catchup_running = True
+            thread = threading.Thread(target=self._catch_up_background, name='catchup-client',
+                                      args=(self.max_instance + 1,))
+            thread.daemon = True
+            thread.start()
 
     def retry_instance(self, inst):
         msg1a = self.make_paxos(PHASE_1A, inst, 1, 0, '')
-        Learner.send_msg(msg1a, self.learner_addr, self.learner_port)
+        self.send_msg(msg1a, self.learner_addr, self.learner_port)
 
-    def delivery_msg(self, inst):
-        d = defer.Deferred()
+    def _is_expensive(self, cmd):
+        """
+        Ask the application whether the command is expensive. A command the
+        application cannot classify is applied inline like any other.
+        """
+        if self.expensive is None:
+            return False
+
+        try:
+            return bool(self.expensive(cmd))
+        except Exception as ex:
+            logging.error("Error classifying command [{}] => [{}]".format(cmd, ex))
+            return False
+
+    def delivery_msg(self, inst, d=None):
+        """
+        Queue the decided command of the instance to be applied, firing d with
+        the result of the application once it is applied.
+        """
+        if d is None:
+            d = defer.Deferred()
 
         try:
             if inst in self.learner.logs:
@@ -213,7 +385,7 @@ class Learner(object):
 
                 logging.info("Trying to deliver [{}]".format(cmd_in_dict))
 
-                self.deliver(cmd_in_dict, d)
+                self.applier.submit(self.deliver, cmd_in_dict, d, self._is_expensive(cmd_in_dict))
 
         except KeyError as ex:
             logging.error("Error while delivering message [{}]".format(ex))
@@ -249,17 +421,27 @@ class Learner(object):
             logging.info("Handling message [{}]".format(unpacked_data))
 
             if typ == PHASE_2B:
-                res = self.learner.handle_p2b(msg)
-                logging.info("Message 2B with req [{}] response [{}]".format(req_id, res))
-
-                if res is not None:
-                    inst = int(res[0])
-                    if self.max_instance < inst:
-                        self.max_instance = inst
-                    d = self.delivery_msg(inst)
-                    d.addCallback(self.respond, req_id, pkt[IP].src,
-                                  pkt[UDP].dport, pkt[UDP].sport)
-                else:
+                self.check_gap(inst)
+
+                with self.lock:
+                    if inst <= self.snapshot_inst and inst not in self.learner.logs:
+                        logging.info("Instance [{}] already covered by the snapshot".format(inst))
+                        return
+
+                    res = self.learner.handle_p2b(msg)
+                    logging.info("Message 2B with req [{}] response [{}]".format(req_id, res))
+
+                    if res is not None:
+                        inst = int(res[0])
+                        if self.max_instance < inst:
+                            self.max_instance = inst
+                        self._advance_commited()
+                        d = defer.Deferred()
+                        d.addCallback(self.respond, req_id, pkt[IP].src,
+                                      pkt[UDP].dport, pkt[UDP].sport)
+                        self.delivery_msg(inst, d)
+
+                if res is None:
                     logging.error("Message with response None, cant be handled [{}]".format(unpacked_data))
             elif typ == PHASE_1B:
                 res = self.learner.handle_p1b(msg)
@@ -277,27 +459,35 @@ class Learner(object):
         except Exception as ex:
             logging.error("Unknown error while handling packet [{}]".format(ex))
 
-    def start(self, count, timeout):
+    def start(self, count, timeout, iface=None):
         """
-        Start a learner by sniffing on all learner's interfaces.
+        Start a learner by sniffing on all learner's interfaces, or only on
+        iface if given.
         """
         logging.debug("| %10s | %4s |  %2s | %2s | %4s | %s |" %
                       ("type", "inst", "pr", "ar", "val", "payload"))
         try:
             if timeout > 0:
-                sniff(count=count, timeout=timeout, filter="udp && dst port 34952",
+                sniff(iface=iface, count=count, timeout=timeout, filter="udp && dst port 34952",
                       prn=lambda x: self.handle_pkt(x), store=0)
             else:
-                sniff(count=count, filter="udp && dst port 34952",
+                sniff(iface=iface, count=count, filter="udp && dst port 34952",
                       prn=lambda x: self.handle_pkt(x), store=0)
         except Exception as e:
             logging.error("Error sniffing [{}]".format(e))
 
         logging.info("Learner finished")
 
+    def drain(self):
+        """
+        Wait until every decided command queued so far has been applied.
+        """
+        self.applier.barrier(lambda: None)
+
     def stop(self):
         """
-        Stop sniffing on the learner's interfaces. Not implemented yet
+        Stop sniffing on the learner's interfaces. Not implemented yet, only
+        applies the commands still queued.
         """
-        pass
+        self.applier.stop()
 # tcpdump -i eth0 -qtNnn port 34952
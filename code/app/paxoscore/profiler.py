@@ -0,0 +1,169 @@
+#!/usr/bin/python
+"""
+Profiling hooks for the backend and proxy processes.
+
+The sampling profiler walks the stacks of all threads at a fixed interval
+and writes them in the collapsed format, one "frame;frame;frame count" line
+per stack, which is the input of flamegraph.pl and speedscope. The timers
+wrap methods of a single object, so nothing is installed and nothing is paid
+when profiling is disabled.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+
+class Timers(object):
+    """
+    Accumulate the number of calls, the total and the maximum wall time of
+    the methods wrapped with install.
+    """
+
+    def __init__(self):
+        self.stats = defaultdict(lambda: [0, 0.0, 0.0])
+        self.lock = threading.Lock()
+
+    def record(self, name, elapsed):
+        with self.lock:
+            stat = self.stats[name]
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] = max(stat[2], elapsed)
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(name, time.time() - start)
+
+        timed.__name__ = func.__name__
+        timed.__doc__ = func.__doc__
+        return timed
+
+    def install(self, obj, names):
+        """
+        Replace the given methods of obj by timed versions, only on this
+        instance, so the class itself is left untouched.
+        """
+        prefix = obj.__class__.__name__
+        for name in names:
+            setattr(obj, name, self.wrap('%s.%s' % (prefix, name), getattr(obj, name)))
+
+    def dump(self, path):
+        with self.lock:
+            stats = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)
+
+        with open(path, 'w') as f:
+            f.write("%-40s %10s %12s %12s %12s\n" % ("function", "calls", "total(s)", "avg(ms)", "max(ms)"))
+            for name, (calls, total, peak) in stats:
+                f.write("%-40s %10d %12.6f %12.6f %12.6f\n" %
+                        (name, calls, total, total * 1000 / calls, peak * 1000))
+
+
+class SamplingProfiler(object):
+    """
+    Sample the stack of every thread of the process during a time window and
+    write the collapsed stacks, and the timers if given, when it finishes.
+    """
+
+    def __init__(self, output, window, interval=0.005, timers=None):
+        """
+        Initialize a profiler with:
+        output: path prefix of the .folded and .timers files
+        window: seconds to sample for, 0 samples until stop is called
+        interval: seconds between two samples
+        timers: optional Timers dumped along with the samples
+        """
+        self.output = output
+        self.window = window
+        self.interval = interval
+        self.timers = timers
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def _sample(self):
+        me = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[';'.join(stack)] += 1
+
+        self.samples += 1
+
+    def _run(self):
+        deadline = time.time() + self.window if self.window > 0 else None
+        while not self.stopped.is_set():
+            if deadline is not None and time.time() >= deadline:
+                break
+            self._sample()
+            self.stopped.wait(self.interval)
+
+        self.dump()
+
+    def start(self):
+        logging.info("Profiling for [{}] seconds into [{}]".format(self.window, self.output))
+        self.thread = threading.Thread(target=self._run, name='profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop sampling and wait for the output to be written.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def dump(self):
+        with open('%s.folded' % self.output, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+
+        if self.timers is not None:
+            self.timers.dump('%s.timers' % self.output)
+
+        logging.info("Profile written with [{}] samples into [{}]".format(self.samples, self.output))
+
+
+def add_arguments(parser):
+    """
+    Add the profiling options to an argparse parser.
+    """
+    parser.add_argument('--profile', type=float, default=None, metavar='SECONDS',
+                        help='Sample the process for SECONDS, 0 until it stops')
+    parser.add_argument('--profile-interval', type=float, default=0.005,
+                        help='Seconds between two samples')
+    parser.add_argument('--profile-output', default='profile',
+                        help='Path prefix of the .folded and .timers files')
+
+
+def from_arguments(args, timers=None):
+    """
+    Create and start a profiler from the parsed arguments, or return None if
+    profiling was not asked.
+    """
+    if args.profile is None:
+        return None
+
+    profiler = SamplingProfiler(args.profile_output, args.profile, args.profile_interval, timers)
+    profiler.start()
+    return profiler
@@ -3,14 +3,22 @@
 __author__ = "Tu Dang"
 
 import logging
+import socket
 import struct
-from twisted.internet import defer
+from collections import deque
+from twisted.internet import defer, reactor
 from twisted.internet.protocol import DatagramProtocol
+from twisted.python import failure
 
 logging.basicConfig(filename="proposer.log", level=logging.DEBUG, format='%(message)s')
 
 VALUE_SIZE = 64
 PHASE_2A = 3
+MAX_INFLIGHT = 254
+REQUEST_TIMEOUT = 5
+ANSWERED_ID_GRACE = 0.1
+TIMEOUT_ID_GRACE = REQUEST_TIMEOUT
+SOCKET_BUFFER = 4 * 1024 * 1024
 
 
 class Proposer(DatagramProtocol):
@@ -29,24 +37,96 @@ class Proposer(DatagramProtocol):
         self.rnd = proposer_id
         self.req_id = 0
         self.defers = {}
+        self.retired = {}
+        self.backlog = deque()
+        self.flush_call = None
+
+    def startProtocol(self):
+        """
+        Enlarge the receive buffer, so the responses to a burst of requests are
+        not dropped while the reactor is busy.
+        """
+        self.transport.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
 
     def submit(self, msg):
         """
         Submit a request with an associated request id. The request id is used
-        to lookup the original request when receiving a response.
+        to lookup the original request when receiving a response. When no
+        request id is free, the request waits until one of them is released.
+        The timeout covers the wait, and the request id is released before the
+        callbacks of the caller run, so they cannot hide a timeout from it.
+        """
+        d = defer.Deferred()
+        slot = [None]
+        d.addTimeout(REQUEST_TIMEOUT, reactor)
+        d.addBoth(self._release, slot, d)
+        self.backlog.append((msg, d, slot))
+        self._flush()
+
+        return d
+
+    def _next_id(self):
+        """
+        Return a request id that is neither in flight nor retired recently, or
+        None if there is no such id.
+        """
+        now = reactor.seconds()
+        for _ in range(MAX_INFLIGHT):
+            self.req_id = self.req_id + 1 if self.req_id + 1 < 255 else 1
+            if self.req_id not in self.defers and self.retired.get(self.req_id, 0) <= now:
+                self.retired.pop(self.req_id, None)
+                return self.req_id
+
+        return None
+
+    def _flush(self):
         """
-        self.req_id = self.req_id + 1 if self.req_id + 1 < 255 else 1
+        Send the waiting requests while there are free request ids. If the only
+        ids left are retired, try again once the first of them can be reused.
+        """
+        while self.backlog:
+            req_id = self._next_id()
+            if req_id is None:
+                if self.retired and self.flush_call is None:
+                    delay = max(0, min(self.retired.values()) - reactor.seconds())
+                    self.flush_call = reactor.callLater(delay, self._scheduled_flush)
+                return
+
+            msg, d, slot = self.backlog.popleft()
+            if d.called:
+                continue
+            slot[0] = req_id
+            self._send(req_id, msg, d)
 
-        values = (PHASE_2A, 0, self.rnd, self.rnd, 0, self.req_id, msg)
+    def _scheduled_flush(self):
+        self.flush_call = None
+        self._flush()
+
+    def _send(self, req_id, msg, d):
+        values = (PHASE_2A, 0, self.rnd, self.rnd, 0, req_id, msg)
         packer = struct.Struct('>' + 'B H B B Q B {0}s'.format(VALUE_SIZE - 1))
         packed_data = packer.pack(*values)
 
-        logging.info("Sending request [{}] with id [{}]".format(packed_data, self.req_id))
+        logging.info("Sending request [{}] with id [{}]".format(packed_data, req_id))
 
         self.transport.write(packed_data, self.dst)
-        self.defers[self.req_id] = defer.Deferred()
+        self.defers[req_id] = d
+
+    def _release(self, result, slot, d):
+        """
+        Retire the request id in slot once the request is answered or timed
+        out. Every learner answers each request and replies can come late, so
+        the id is only reused after a grace period, longer for a request that
+        timed out. A request timing out in the backlog has no id yet.
+        """
+        req_id = slot[0]
+        if req_id is not None and self.defers.get(req_id) is d:
+            self.defers.pop(req_id)
+            grace = TIMEOUT_ID_GRACE if isinstance(result, failure.Failure) else ANSWERED_ID_GRACE
+            self.retired[req_id] = reactor.seconds() + grace
 
-        return self.defers[self.req_id]
+        self._flush()
+        return result
 
     def datagramReceived(self, datagram, address):
         """
@@ -63,7 +143,6 @@ class Proposer(DatagramProtocol):
             if req_id in self.defers:
                 logging.info("Response received [{}] with id [{}]".format(result, req_id))
                 self.defers[req_id].callback(result)
-                self.defers.pop(req_id)
         except defer.AlreadyCalledError as ex:
             logging.error("Error while handling response: [{}]".format(ex.message))
         except Exception as ex:
@@ -0,0 +1,332 @@
+#!/usr/bin/python
+"""
+Record Paxos traffic to pcap and replay it into a learner, to measure the
+learner throughput and latency without bringing up the switches.
+
+    replay.py record --cfg paxos.cfg --iface eth0 --output paxos.pcap
+    replay.py replay --cfg paxos.cfg --input paxos.pcap --speed 0 --loss 0.01
+    replay.py replay --cfg paxos.cfg --input paxos.pcap --expensive-prefix k1 --apply-delay 0.005
+
+In udp mode the payloads go to the learner port on --addr, so the backend
+must be sniffing on that interface, e.g. backend.py --iface lo, which also
+sends its replies through a raw L3 socket so they reach 127.0.0.1.
+"""
+
+import ConfigParser
+import argparse
+import random
+import socket
+import struct
+import threading
+import time
+from collections import defaultdict, deque
+from scapy.all import *
+
+from backend import SimpleDatabase
+from paxoscore.learner import Learner, PHASE_1B, PHASE_2B
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(THIS_DIR)
+
+
+class ReplaySink(object):
+    """
+    Stand-in for the network of an in-process learner, counting the replies
+    and the messages it would have sent instead of sending them. Replies are
+    made from the apply threads, hence the lock.
+    """
+
+    def __init__(self):
+        self.responses = 0
+        self.messages = 0
+        self.lock = threading.Lock()
+
+    def respond(self, result, req_id, dst, sport, dport):
+        with self.lock:
+            self.responses += 1
+
+    def timed(self, stats, start):
+        """
+        Return a respond recording the time since start, when the decided
+        command of the packet is applied and its reply would be sent.
+        """
+        def respond(result, req_id, dst, sport, dport):
+            stats.add(time.time() - start)
+            self.respond(result, req_id, dst, sport, dport)
+
+        return respond
+
+    def send_msg(self, msg, dst, dport):
+        self.messages += 1
+
+
+class ReplayStats(object):
+    """
+    Collect the latency of each replied request and report the throughput.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.start = None
+        self.end = None
+
+    def begin(self):
+        self.start = time.time()
+
+    def finish(self):
+        self.end = time.time()
+
+    def add(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def percentile(self, p):
+        ordered = sorted(self.latencies)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def report(self, sent, responses):
+        elapsed = self.end - self.start
+        print("packets   : %d" % sent)
+        print("responses : %d" % responses)
+        print("elapsed   : %.6f s" % elapsed)
+        print("throughput: %.1f pkt/s" % (sent / elapsed if elapsed > 0 else 0))
+        if self.latencies:
+            print("latency   : avg %.3f ms, p50 %.3f ms, p99 %.3f ms, max %.3f ms" %
+                  (sum(self.latencies) * 1000 / len(self.latencies),
+                   self.percentile(0.5) * 1000, self.percentile(0.99) * 1000,
+                   max(self.latencies) * 1000))
+
+
+def inject(packets, loss, duplicate, reorder, window, rng):
+    """
+    Drop, duplicate and reorder the packets with the given probabilities. A
+    reordered packet is delayed by up to window positions.
+    """
+    delayed = []
+    position = 0
+    for pkt in packets:
+        if rng.random() < loss:
+            continue
+
+        copies = 2 if rng.random() < duplicate else 1
+        for _ in range(copies):
+            if rng.random() < reorder:
+                delayed.append((position + rng.randint(1, window), pkt))
+            else:
+                yield pkt
+                position += 1
+
+            ready = [item for item in delayed if item[0] <= position]
+            delayed = [item for item in delayed if item[0] > position]
+            for _, late in ready:
+                yield late
+                position += 1
+
+    for _, late in sorted(delayed, key=lambda item: item[0]):
+        yield late
+
+
+def paced(packets, speed):
+    """
+    Yield the packets following the captured inter-arrival times scaled by
+    speed, or as fast as possible when speed is 0.
+    """
+    first = None
+    start = None
+    for pkt in packets:
+        if speed > 0:
+            if first is None:
+                first = pkt.time
+                start = time.time()
+            wait = start + float(pkt.time - first) / speed - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        yield pkt
+
+
+def load(path, port):
+    """
+    Load the 1B and 2B messages sent to the learner port.
+    """
+    packets = [pkt for pkt in rdpcap(path)
+               if UDP in pkt and Raw in pkt and pkt[UDP].dport == port and
+               ord(str(pkt[Raw].load)[:1] or '\0') in (PHASE_1B, PHASE_2B)]
+    logging.info("Loaded [{}] learner packets from [{}]".format(len(packets), path))
+    return packets
+
+
+def record(args, config):
+    learner_port = config.getint('learner', 'port')
+    proposer_port = config.getint('proposer', 'port')
+    writer = PcapWriter(args.output, append=False, sync=False)
+    try:
+        sniff(iface=args.iface, count=args.count, timeout=args.timeout or None,
+              filter="udp && (port %d || port %d)" % (learner_port, proposer_port),
+              prn=writer.write, store=0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+
+
+def replay_inproc(args, config, packets):
+    """
+    Feed the packets to a learner in this process. The latency of a request
+    goes from the handling of the packet deciding it to its reply, so it
+    includes the time spent in the apply stage.
+    """
+    num_acceptors = config.getint('common', 'num_acceptors')
+    learner_addr = config.get('learner', 'addr')
+    learner_port = config.getint('learner', 'port')
+    if config.has_section('apply'):
+        learner = Learner(num_acceptors, learner_addr, learner_port,
+                          config.getint('apply', 'queue'), config.getint('apply', 'workers'))
+    else:
+        learner = Learner(num_acceptors, learner_addr, learner_port)
+
+    sink = ReplaySink()
+    learner.send_msg = sink.send_msg
+
+    dbserver = SimpleDatabase(args.expensive_prefix)
+    offloaded = []
+
+    def deliver(cmd, d):
+        if dbserver.is_expensive(cmd):
+            time.sleep(args.apply_delay)
+        if threading.current_thread() is not learner.applier.thread:
+            offloaded.append(cmd)
+        dbserver.execute(cmd, d)
+
+    learner.add_deliver(deliver, dbserver.is_expensive)
+
+    stats = ReplayStats()
+    sent = 0
+    stats.begin()
+    for pkt in packets:
+        learner.respond = sink.timed(stats, time.time())
+        learner.handle_pkt(pkt)
+        sent += 1
+    learner.drain()
+    stats.finish()
+    stats.report(sent, sink.responses)
+    print("offloaded : %d commands applied on the workers" % len(offloaded))
+    learner.stop()
+
+
+def replay_udp(args, config, packets):
+    """
+    Send the payloads to a learner sniffing on the loopback. Replies only carry
+    the request id, so each one is matched to the oldest (instance, request id)
+    still waiting for replies with that id, and the latency goes from the first
+    packet sent for that pair to its first reply.
+    """
+    dst = (args.addr, config.getint('learner', 'port'))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('', 0))
+    sock.setblocking(False)
+
+    stats = ReplayStats()
+    pending = {}
+    waiting = defaultdict(deque)
+    sent = 0
+    responses = 0
+
+    def drain():
+        received = 0
+        while True:
+            try:
+                data = sock.recv(2048)
+            except socket.error:
+                return received
+            received += 1
+
+            queue = waiting[ord(data[0])]
+            if not queue:
+                continue
+            key = queue[0]
+            entry = pending[key]
+            if not entry[2]:
+                stats.add(time.time() - entry[0])
+                entry[2] = True
+            entry[1] -= 1
+            if entry[1] == 0:
+                queue.popleft()
+                del pending[key]
+
+    stats.begin()
+    for pkt in packets:
+        payload = str(pkt[Raw].load)
+        if ord(payload[0]) == PHASE_2B:
+            inst, req_id = struct.unpack('>H', payload[1:3])[0], ord(payload[13])
+            key = (inst, req_id)
+            if key not in pending:
+                pending[key] = [time.time(), 0, False]
+                waiting[req_id].append(key)
+            pending[key][1] += 1
+        sock.sendto(payload, dst)
+        sent += 1
+        responses += drain()
+
+    deadline = time.time() + args.drain
+    while time.time() < deadline and pending:
+        responses += drain()
+        time.sleep(0.001)
+    stats.finish()
+    stats.report(sent, responses)
+
+
+def replay(args, config):
+    packets = load(args.input, config.getint('learner', 'port'))
+    rng = random.Random(args.seed)
+    packets = inject(packets, args.loss, args.duplicate, args.reorder, args.window, rng)
+    packets = paced(packets, args.speed)
+
+    if args.mode == 'udp':
+        replay_udp(args, config, packets)
+    else:
+        replay_inproc(args, config, packets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Paxos pcap record and replay.')
+    parser.add_argument('--cfg', required=True)
+    commands = parser.add_subparsers(dest='command')
+
+    rec = commands.add_parser('record', help='Record Paxos traffic to pcap')
+    rec.add_argument('--iface', default=None)
+    rec.add_argument('--output', required=True)
+    rec.add_argument('--count', type=int, default=0)
+    rec.add_argument('--timeout', type=int, default=0)
+
+    rep = commands.add_parser('replay', help='Replay a pcap into a learner')
+    rep.add_argument('--input', required=True)
+    rep.add_argument('--mode', choices=['inproc', 'udp'], default='inproc')
+    rep.add_argument('--addr', default='127.0.0.1', help='Learner address in udp mode')
+    rep.add_argument('--speed', type=float, default=0,
+                     help='Scale of the captured rate, 0 replays at line rate')
+    rep.add_argument('--loss', type=float, default=0)
+    rep.add_argument('--duplicate', type=float, default=0)
+    rep.add_argument('--reorder', type=float, default=0)
+    rep.add_argument('--window', type=int, default=8, help='Maximum reordering distance')
+    rep.add_argument('--seed', type=int, default=0)
+    rep.add_argument('--drain', type=float, default=1, help='Seconds to wait for replies in udp mode')
+    rep.add_argument('--expensive-prefix', default=None,
+                     help='Mark the commands on keys with this prefix expensive in inproc mode')
+    rep.add_argument('--apply-delay', type=float, default=0,
+                     help='Seconds an expensive command takes to apply in inproc mode')
+
+    args = parser.parse_args()
+    config = ConfigParser.ConfigParser()
+    config.read(args.cfg)
+
+    if args.command == 'record':
+        record(args, config)
+    else:
+        replay(args, config)
+
+
+if __name__ == '__main__':
+    main()
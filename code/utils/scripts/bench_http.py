@@ -0,0 +1,156 @@
+#!/usr/bin/env python2.7
+"""
+Benchmark the web front-end over persistent, pipelined HTTP/1.1 connections,
+comparing one operation per request on /put and /get with /batch.
+
+    python bench_http.py --host 10.0.0.1 --mode put --ops 10000 --depth 16
+    python bench_http.py --host 10.0.0.1 --mode batch --ops 10000 --batch 100
+
+The client counts its own send and recv calls per operation. To count the
+calls of the server, run it under strace -c -f -p <pid> during the benchmark.
+"""
+
+import argparse
+import json
+import socket
+import time
+import urllib
+
+
+class PipelinedClient(object):
+    """
+    HTTP/1.1 client keeping up to depth requests in flight on one connection.
+    """
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.host = host
+        self.buffer = ''
+        self.sends = 0
+        self.recvs = 0
+
+    def request(self, method, path, body=''):
+        headers = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % self.host]
+        if method == 'POST':
+            headers.append('Content-Type: application/x-www-form-urlencoded')
+            headers.append('Content-Length: %d' % len(body))
+        return '\r\n'.join(headers) + '\r\n\r\n' + body
+
+    def send(self, data):
+        self.sock.sendall(data)
+        self.sends += 1
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        self.recvs += 1
+        if not data:
+            raise IOError("Connection closed by the server")
+        self.buffer += data
+
+    def _read_until(self, marker):
+        while marker not in self.buffer:
+            self._fill()
+        index = self.buffer.index(marker)
+        data, self.buffer = self.buffer[:index], self.buffer[index + len(marker):]
+        return data
+
+    def _read_exact(self, size):
+        while len(self.buffer) < size:
+            self._fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def response(self):
+        """
+        Read one response, with either a content length or a chunked body.
+        """
+        head = self._read_until('\r\n\r\n').split('\r\n')
+        status = int(head[0].split()[1])
+        headers = dict((k.strip().lower(), v.strip()) for k, v in
+                       (line.split(':', 1) for line in head[1:]))
+
+        if headers.get('transfer-encoding') == 'chunked':
+            body = []
+            while True:
+                size = int(self._read_until('\r\n').split(';')[0], 16)
+                if size == 0:
+                    self._read_until('\r\n')
+                    break
+                body.append(self._read_exact(size))
+                self._read_exact(2)
+            return status, ''.join(body)
+
+        return status, self._read_exact(int(headers.get('content-length', 0)))
+
+    def close(self):
+        self.sock.close()
+
+
+def operations(mode, count):
+    for i in range(count):
+        if mode == 'get':
+            yield {'action': 'get', 'key': 'b%d' % i}
+        else:
+            yield {'action': 'put', 'key': 'b%d' % i, 'value': 'v%d' % i}
+
+
+def encode(client, mode, ops):
+    if mode == 'batch':
+        return client.request('POST', '/batch', json.dumps(ops))
+
+    op = ops[0]
+    if op['action'] == 'get':
+        return client.request('GET', '/get?%s' % urllib.urlencode({'key': op['key']}))
+    return client.request('POST', '/put', urllib.urlencode({'key': op['key'], 'value': op['value']}))
+
+
+def run(args):
+    client = PipelinedClient(args.host, args.port)
+    size = args.batch if args.mode == 'batch' else 1
+    action = 'put' if args.mode == 'batch' else args.mode
+    ops = list(operations(action, args.ops))
+    requests = [ops[i:i + size] for i in range(0, len(ops), size)]
+
+    errors = 0
+    inflight = 0
+    sent = 0
+    start = time.time()
+    while sent < len(requests) or inflight:
+        pending = []
+        while sent < len(requests) and inflight + len(pending) < args.depth:
+            pending.append(encode(client, args.mode, requests[sent]))
+            sent += 1
+        if pending:
+            client.send(''.join(pending))
+            inflight += len(pending)
+
+        status, _ = client.response()
+        inflight -= 1
+        if status != 200:
+            errors += 1
+    elapsed = time.time() - start
+    client.close()
+
+    print("mode        : %s" % args.mode)
+    print("operations  : %d in %d requests, %d errors" % (len(ops), len(requests), errors))
+    print("elapsed     : %.3f s" % elapsed)
+    print("requests/s  : %.1f" % (len(requests) / elapsed))
+    print("operations/s: %.1f" % (len(ops) / elapsed))
+    print("syscalls/op : %.3f send, %.3f recv" %
+          (float(client.sends) / len(ops), float(client.recvs) / len(ops)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP front-end benchmark.')
+    parser.add_argument('--host', default='10.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--mode', choices=['put', 'get', 'batch'], default='put')
+    parser.add_argument('--ops', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=100, help='Operations per /batch request')
+    parser.add_argument('--depth', type=int, default=1, help='Pipelined requests per connection')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()